@@ -1,14 +1,24 @@
-import os, json, logging, re
+import os, logging, functools, hashlib, asyncio
+from typing import List
+from urllib.parse import urlparse, unquote
 import azure.functions as func
 
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, DocumentField
-from azure.core.credentials import AzureKeyCredential
-from azure.storage.blob import BlobServiceClient
+from azure.ai.documentintelligence.models import DocumentField
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceNotFoundError
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient  # async: uploads/SQL en parallèle
 
-# --- NEW: SQL via python-tds (pur Python) ---
+# --- Helpers appelés par champ / par facture, compilés AOT par mypyc (cf. setup.py)
+from invoice_fields import extract_value, to_date, to_amount
+
+# --- SQL via fastmssql (driver Rust async, pool de connexions intégré) ---
 import datetime as dt
-import tds  # pip install python-tds
+from fastmssql import Connection, Transaction, TypedNull, SqlError  # pip install fastmssql
+
+# --- Document Intelligence en REST + parsing JSON en flux
+import httpx
+import ijson
+import orjson  # encodage JSON natif (C/SIMD), produit directement des bytes
 
 # --- Function App (Python v2)
 app = func.FunctionApp()
@@ -17,142 +27,498 @@ app = func.FunctionApp()
 ENDPOINT = (os.getenv("AZURE_DI_ENDPOINT") or "").strip().rstrip("/")
 KEY      = (os.getenv("AZURE_DI_KEY") or "").strip()
 MODEL_ID = (os.getenv("AZURE_DI_MODEL_ID") or "").strip()
+DI_API_VERSION = os.getenv("AZURE_DI_API_VERSION", "2024-11-30")
+# Durée max d'une analyse (polling compris) avant abandon: l'évènement est alors rejoué
+DI_POLL_TIMEOUT = float(os.getenv("AZURE_DI_POLL_TIMEOUT", "300"))
+# Analyses DI simultanées par worker (un lot peut compter 50 messages): rester sous le quota TPS (S0: 15)
+DI_MAX_CONCURRENCY = int(os.getenv("AZURE_DI_MAX_CONCURRENCY", "4"))
 
 ARCHIVE_CONTAINER = os.getenv("ARCHIVE_CONTAINER", "archive")
 STORAGE_CONN_STR  = os.getenv("AzureWebJobsStorage")
+SOURCE_CONTAINER  = "eem-training"
+# Téléchargements simultanés pour le hachage des PDF (bande passante / mémoire du worker)
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "8"))
 
-# SQL (format simple conseillé: Server=...;Database=...;User Id=...;Password=...;Encrypt=yes)
+# SQL (chaîne ADO.NET: Server=tcp:...,1433;Database=...;User Id=...;Password=...;Encrypt=yes)
 SQL_CONN_STR      = os.getenv("SQL_CONN_STR", "")
 DEFAULT_STATUS_ID = int(os.getenv("DEFAULT_STATUS_ID", "1"))
 DEFAULT_SITE_ID   = int(os.getenv("DEFAULT_SITE_ID", "1"))
 CREATED_BY        = os.getenv("CREATED_BY", "function-app")
 
-# --- Clients
-di_client = DocumentIntelligenceClient(endpoint=ENDPOINT, credential=AzureKeyCredential(KEY))
-blob_service = BlobServiceClient.from_connection_string(STORAGE_CONN_STR)
-archive_container = blob_service.get_container_client(ARCHIVE_CONTAINER)
-
-def extract_value(field: DocumentField):
-    ftype = getattr(field, "type", None) or getattr(field, "value_type", None)
-    if ftype in ("string","countryRegion","phoneNumber"): return field.value_string
-    if ftype == "date": return str(field.value_date)
-    if ftype == "time": return str(field.value_time)
-    if ftype == "integer": return field.value_integer
-    if ftype in ("number","float"): return field.value_number
-    if ftype == "currency":
-        cur = field.value_currency
-        if cur:
-            return {"amount": getattr(cur,"amount",None),
-                    "currency": getattr(cur,"currency_code",None) or getattr(cur,"currency_symbol",None)}
+# --- Clients: créés à la 1re utilisation (import léger au cold start), puis réutilisés
+# par toutes les invocations du worker (pools HTTP / session aiohttp conservés).
+@functools.lru_cache(maxsize=1)
+def _di() -> httpx.AsyncClient:
+    return httpx.AsyncClient(base_url=ENDPOINT, headers={"Ocp-Apim-Subscription-Key": KEY}, timeout=60)
+
+@functools.lru_cache(maxsize=1)
+def _blob_service() -> BlobServiceClient:
+    return BlobServiceClient.from_connection_string(STORAGE_CONN_STR)
+
+@functools.lru_cache(maxsize=1)
+def _archive():
+    return _blob_service().get_container_client(ARCHIVE_CONTAINER)
+
+# Limites partagées par tous les évènements (et invocations) du worker
+_DI_SLOTS       = asyncio.Semaphore(DI_MAX_CONCURRENCY)
+_DOWNLOAD_SLOTS = asyncio.Semaphore(BLOB_DOWNLOAD_CONCURRENCY)
+
+# ---------- Document Intelligence (REST, réponse lue en flux) ----------
+# Seuls ces champs sont utilisés en aval: le reste de analyzeResult n'est jamais matérialisé.
+INVOICE_FIELDS = ("NumeroFacture", "DateEmission", "DateEcheance", "MontantTotal")
+_DOC_PREFIX    = "analyzeResult.documents.item"
+_FIELDS_PREFIX = f"{_DOC_PREFIX}.fields"
+# Codes d'erreur DI (innererror) propres au document lui-même: rejouer n'y changera rien.
+# Une analyse en échec pour une autre raison (source inaccessible, SAS expiré...) est rejouée
+# puis dead-letter; un 4xx synchrone suit la règle générale de _is_permanent.
+_DI_CONTENT_ERRORS = frozenset(("InvalidContent", "InvalidContentDimensions", "InvalidContentLength"))
+
+# Throttling / indisponibilité DI: réessayés sur place (Retry-After ou backoff) plutôt que de rejouer tout le lot
+_DI_RETRY_STATUS  = (429, 503)
+_DI_MAX_ATTEMPTS  = 5
+
+def _retry_delay(resp: httpx.Response, attempt: int) -> float:
+    # Retry-After (secondes) s'il est fourni, sinon backoff exponentiel 1, 2, 4, 8 s
+    try:
+        return float(resp.headers["retry-after"])
+    except (KeyError, ValueError):
+        return float(2 ** attempt)
+
+class DocumentRejected(Exception):
+    """Document refusé par DI pour son contenu (corrompu, format non supporté, trop gros): définitif."""
+
+def _di_error(body: bytes):
+    """Corps d'erreur DI -> (code le plus précis, message)."""
+    try:
+        error = orjson.loads(body).get("error") or {}
+    except (orjson.JSONDecodeError, AttributeError):
+        return None, None
+    return (error.get("innererror") or {}).get("code") or error.get("code"), error.get("message")
+
+async def _parse_analyze_result(chunks):
+    """Parse en flux une réponse analyzeResults -> (status, (code, message) d'erreur, nb documents, champs bruts du 1er document)."""
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    status, code, message, ndocs, fields = None, None, None, 0, {}
+    name, builder = None, None
+    async for chunk in chunks:
+        parser.send(chunk)
+        for prefix, event, value in events:
+            if builder is not None:
+                builder.event(event, value)
+                if event == "end_map" and prefix == f"{_FIELDS_PREFIX}.{name}":
+                    fields[name] = builder.value
+                    name, builder = None, None
+            elif event == "map_key" and prefix == _FIELDS_PREFIX and ndocs == 1 and value in INVOICE_FIELDS:
+                name, builder = value, ijson.ObjectBuilder()
+            elif event == "start_map" and prefix == _DOC_PREFIX:
+                ndocs += 1
+            elif prefix == "status":
+                status = value
+            elif prefix == "error.innererror.code":
+                code = value
+            elif prefix == "error.code":
+                code = code or value
+            elif prefix == "error.message":
+                message = value
+        del events[:]
+    parser.close()
+    return status, (code, message), ndocs, fields
+
+async def analyze_invoice(source_url: str):
+    """Analyse DI du document (lu par DI via urlSource) -> {champ: DocumentField} du 1er document, None si aucun."""
+    client = _di()
+    for attempt in range(_DI_MAX_ATTEMPTS):
+        r = await client.post(f"/documentintelligence/documentModels/{MODEL_ID}:analyze",
+                        params={"api-version": DI_API_VERSION}, json={"urlSource": source_url})
+        if r.status_code not in _DI_RETRY_STATUS or attempt == _DI_MAX_ATTEMPTS - 1:
+            break
+        await asyncio.sleep(_retry_delay(r, attempt))
+    if r.status_code in (400, 415):
+        code, message = _di_error(r.content)
+        if r.status_code == 415 or code in _DI_CONTENT_ERRORS:
+            raise DocumentRejected(f"{r.status_code} {code}: {message}")
+    r.raise_for_status()
+    op_url = r.headers["operation-location"]
+    wait = _retry_delay(r, 0)
+    deadline = asyncio.get_running_loop().time() + DI_POLL_TIMEOUT
+    throttled = 0
+
+    while True:
+        if asyncio.get_running_loop().time() + wait > deadline:
+            raise TimeoutError(f"Analyse DI non terminée après {DI_POLL_TIMEOUT:.0f} s: {op_url}")
+        await asyncio.sleep(wait)
+        async with client.stream("GET", op_url) as resp:
+            if resp.status_code in _DI_RETRY_STATUS and throttled < _DI_MAX_ATTEMPTS - 1:
+                wait = _retry_delay(resp, throttled)
+                throttled += 1
+                continue
+            resp.raise_for_status()
+            throttled = 0
+            wait = _retry_delay(resp, 0)
+            status, error, ndocs, fields = await _parse_analyze_result(resp.aiter_bytes())
+        if status == "succeeded":
+            break
+        if status not in ("notStarted", "running"):
+            code, message = error
+            if code in _DI_CONTENT_ERRORS:
+                raise DocumentRejected(f"{status} {code}: {message}")
+            raise HttpResponseError(message=f"Analyse DI en échec ({status}, {code}): {message}")
+
+    if not ndocs:
+        return None
+    return {name: DocumentField(raw) for name, raw in fields.items()}
+
+async def analyze_blob(blob):
+    # SAS créé une fois le créneau obtenu: l'attente ne consomme pas sa durée de validité
+    async with _DI_SLOTS:
+        return await analyze_invoice(_read_sas_url(blob))
+
+# ---------- Cache DI adressé par contenu (archive/cache/<model>/<clé>.json) ----------
+# Un même fichier (retry, ré-upload) n'est analysé qu'une fois par modèle.
+async def _content_digest(blob):
+    """-> (SHA-256 du contenu, taille, ETag de la version lue)."""
+    # SHA-256 du contenu, calculé en flux. Pas de Content-MD5: fixé par le client qui dépose le
+    # fichier (donc falsifiable) et sujet aux collisions. Coût: un téléchargement complet du PDF
+    # par évènement, y compris en cas de cache hit (mais sans jamais le garder en mémoire).
+    async with _DOWNLOAD_SLOTS:
+        downloader = await blob.download_blob()
+        h = hashlib.sha256()
+        async for chunk in downloader.chunks():
+            h.update(chunk)
+    return h.digest(), downloader.size, downloader.properties.etag
+
+def _cache_blob_name(digest: bytes) -> str:
+    model = MODEL_ID.encode("utf-8")
+    # préfixe de longueur sur 8 octets + séparateur: (model, hash) -> clé sans collision possible
+    key = hashlib.sha256(len(model).to_bytes(8, "big") + model + b"\0" + digest)
+    return f"cache/{MODEL_ID}/{key.hexdigest()}.json"
+
+async def load_cached_fields(cache_name: str):
+    try:
+        downloader = await _archive().get_blob_client(cache_name).download_blob()
+        return orjson.loads(await downloader.readall())
+    except ResourceNotFoundError:
         return None
-    if ftype == "array": return [extract_value(x) for x in (field.value_array or [])]
-    if ftype in ("object","dictionary","map"):
-        obj = field.value_object or {}
-        return {k: extract_value(v) for k,v in obj.items()}
-    return field.content
-
-def save_json_to_archive(source_blob_name: str, data: dict):
-    base = os.path.basename(source_blob_name)
-    stem = os.path.splitext(base)[0]
+    except orjson.JSONDecodeError as e:
+        # entrée corrompue (écriture interrompue...): traitée comme absente, réécrite après analyse
+        logging.warning(f"Cache DI illisible, ignoré ({cache_name}): {e}")
+        return None
+
+async def save_cached_fields(cache_name: str, data: dict):
+    await _upload_json(cache_name, data)
+
+def _read_sas_url(blob) -> str:
+    # SAS lecture seule, 10 min: DI télécharge le PDF directement depuis le stockage
+    sas = generate_blob_sas(blob.account_name, blob.container_name, blob.blob_name,
+                            account_key=_blob_service().credential.account_key,
+                            permission=BlobSasPermissions(read=True),
+                            expiry=dt.datetime.now(dt.UTC) + dt.timedelta(minutes=10))
+    return f"{blob.url}?{sas}"
+
+async def _upload_json(name: str, data: dict):
+    # JSON compact (à ré-indenter à la lecture si besoin), déjà en bytes UTF-8.
+    # length connue -> un seul Put Blob sans sondage de taille (quelques Ko, loin de la limite single-put)
+    payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    await _archive().upload_blob(name=name, data=payload, length=len(payload), overwrite=True)
+
+async def archive_raw_copy(original: str, source_url: str):
+    # Copie brute du PDF dans archive/raw/, faite côté serveur (Put Blob From URL): aucun octet
+    # ne transite par le worker. Copie d'audit accessoire: un échec (HTTP ou réseau) est journalisé,
+    # pas bloquant — il ne doit pas faire perdre une analyse DI déjà payée.
+    out_name = f"raw/{original}"
+    try:
+        await _archive().get_blob_client(out_name).upload_blob_from_url(source_url, overwrite=True)
+    except AzureError as e:
+        logging.warning(f"Copie brute non archivée ({out_name}): {e}")
+
+async def save_json_to_archive(stem: str, data: dict):
     out_name = f"{stem}.json"
-    payload = json.dumps(data, ensure_ascii=False, indent=2)
-    archive_container.upload_blob(name=out_name, data=payload, overwrite=True)
+    await _upload_json(out_name, data)
     logging.info(f"🗄️ JSON archivé dans {ARCHIVE_CONTAINER}/{out_name}")
 
-# ---------- SQL (python-tds) ----------
-_CONN_RE = re.compile(
-    r"Server=tcp:([^,]+),(\d+);Database=([^;]+);User Id=([^;]+);Password=([^;]+);", re.I
-)
+# ---------- SQL (fastmssql) ----------
+# Synonymes ADO.NET acceptés par le driver (chaîne copiée du portail: Data Source=...;Initial Catalog=...)
+_SERVER_KEYS   = ("server", "data source", "address", "addr", "network address")
+_DATABASE_KEYS = ("database", "initial catalog")
 
-def _connect_sql_from_connstr(conn_str: str):
-    m = _CONN_RE.search(conn_str or "")
-    if not m:
+def _check_conn_str(conn_str: str):
+    # Validée une seule fois à l'import: une config incomplète échoue au cold start, pas en pleine requête
+    kv = {k.strip().lower(): v.strip() for k, _, v in (p.partition("=") for p in conn_str.split(";")) if v.strip()}
+    if not any(kv.get(k) for k in _SERVER_KEYS) or not any(kv.get(k) for k in _DATABASE_KEYS):
         raise ValueError("SQL_CONN_STR invalide. Attendu: "
                          "Server=tcp:<srv>,1433;Database=<db>;User Id=<user>;Password=<pwd>;Encrypt=yes")
-    server, port, database, user, pwd = m.group(1), int(m.group(2)), m.group(3), m.group(4), m.group(5)
-    return tds.connect(
-        server=server, port=port, user=user, password=pwd,
-        database=database, encrypt=True, autocommit=False
-    )
-
-def save_to_db(fields: dict, blob_name: str, account_url: str, container: str):
-    # Champs issus du modèle
-    num   = (fields.get("NumeroFacture") or {}).get("value")
-    issue = (fields.get("DateEmission")  or {}).get("value")
-    due   = (fields.get("DateEcheance")  or {}).get("value")
-    amt   = (fields.get("MontantTotal")  or {}).get("value")
-
-    # Normalisation date / montant
-    def to_date(s):
-        if not s: return None
-        for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%d/%m/%Y"):
-            try: return dt.datetime.strptime(str(s), fmt)
-            except: pass
-        return None
 
-    def to_amount(s):
-        if s is None: return 0.0
-        return float(str(s).replace(" ", "").replace("\u00a0","").replace(".", "").replace(",", "."))
+_check_conn_str(SQL_CONN_STR)
 
-    date_issue = to_date(issue)
-    date_due   = to_date(due)
-    amount     = to_amount(amt)
-    now        = dt.datetime.utcnow()
+# Pool créé paresseusement à la 1re requête puis réutilisé par toutes les invocations du worker.
+# fastmssql lit la chaîne ADO.NET telle quelle: plus d'analyse côté Python à chaque insert.
+SQL = Connection(SQL_CONN_STR)
 
-    original = os.path.basename(blob_name)
-    file_url = f"{account_url}/{container}/{original}"
+# Lot de factures -> une seule requête et une seule transaction.
+# Paramètres communs @P1..@P5, puis 7 paramètres par facture (cf. save_to_db). Horodatage de
+# création pris côté serveur (SYSUTCDATETIME): fastmssql tronquerait un datetime Python en DATE.
+# SQL Server plafonne à 2100 paramètres par requête: au-delà de _SQL_MAX_ROWS factures,
+# le lot est découpé en plusieurs requêtes exécutées dans une même transaction.
+# Les Id des nouveaux AppFile sont rattachés aux factures via SourceId (unique dans le lot).
+# Idempotent: une facture déjà enregistrée pour le même blob avec les mêmes champs (lot rejoué,
+# reprise facture par facture) n'est pas réinsérée. Les verrous UPDLOCK/HOLDLOCK sont tenus jusqu'au
+# COMMIT: deux workers qui traitent le même blob ne peuvent pas insérer chacun leur ligne.
+_INSERT_INVOICES_SQL = """
+    SET XACT_ABORT ON;
+    DECLARE @now DATETIME2 = SYSUTCDATETIME();
+    DECLARE @rows TABLE (SourceId NVARCHAR(MAX), FileName NVARCHAR(MAX), FileUrl NVARCHAR(MAX),
+                         Number NVARCHAR(MAX), DateIssue DATETIME2, DateDue DATETIME2, Amount FLOAT);
+    DECLARE @file TABLE (Id BIGINT, SourceId NVARCHAR(MAX));
+    INSERT INTO @rows VALUES {values};
 
-    with _connect_sql_from_connstr(SQL_CONN_STR) as conn:
-        cur = conn.cursor()
+    BEGIN TRAN;
+    DELETE r FROM @rows r
+    WHERE EXISTS (SELECT 1 FROM files.AppFile f WITH (UPDLOCK, HOLDLOCK)
+                  JOIN invoices.Invoice i ON i.FileId = f.Id
+                  WHERE f.SourceName = @P5 AND f.ContainerName = @P1 AND f.SourceId = r.SourceId
+                    AND EXISTS (SELECT r.Number, r.DateIssue, r.DateDue, r.Amount
+                                INTERSECT SELECT i.Number, i.DateIssue, i.DateDue, i.Amount));
 
-        # files.AppFile
-        cur.execute("""
-            INSERT INTO files.AppFile
-            (SourceName, SourceId, ContainerName, OriginalFileName, SystemFileName, DateCreation, FileUrl)
-            OUTPUT INSERTED.Id
-            VALUES (?,?,?,?,?,?,?)
-        """, ("blobTrigger", blob_name, container, original, original, now, file_url))
-        row = cur.fetchone()
-        file_id = row[0] if row else None
+    INSERT INTO files.AppFile
+    (SourceName, SourceId, ContainerName, OriginalFileName, SystemFileName, DateCreation, FileUrl)
+    OUTPUT INSERTED.Id, INSERTED.SourceId INTO @file(Id, SourceId)
+    SELECT @P5, SourceId, @P1, FileName, FileName, @now, FileUrl FROM @rows;
 
-        # invoices.Invoice
-        cur.execute("""
-            INSERT INTO invoices.Invoice
-            (Number, SiteId, RefInvoiceStatusId, IsArchived, DateIssue, DateDue, Amount, FileId, DateCreated, CreatedBy)
-            VALUES (?,?,?,?,?,?,?,?,?,?)
-        """, (num or "", DEFAULT_SITE_ID, DEFAULT_STATUS_ID, 0, date_issue, date_due, amount, file_id, now, CREATED_BY))
+    INSERT INTO invoices.Invoice
+    (Number, SiteId, RefInvoiceStatusId, IsArchived, DateIssue, DateDue, Amount, FileId, DateCreated, CreatedBy)
+    SELECT r.Number, @P2, @P3, 0, r.DateIssue, r.DateDue, r.Amount, f.Id, @now, @P4
+    FROM @rows r JOIN @file f ON f.SourceId = r.SourceId;
+    COMMIT;
+"""
+# Colonnes de @rows dans l'ordre de save_to_db. fastmssql envoie tout datetime.datetime en DATE
+# (heure perdue): les dates de facture partent en texte ISO 8601 et sont typées côté serveur.
+_ROW_COLUMNS = ("{}", "{}", "{}", "{}", "CAST({} AS DATETIME2)", "CAST({} AS DATETIME2)", "{}")
+_SQL_COMMON_PARAMS = 5
+_SQL_ROW_PARAMS    = len(_ROW_COLUMNS)
+_SQL_MAX_ROWS      = (2100 - _SQL_COMMON_PARAMS) // _SQL_ROW_PARAMS   # 299
 
-        conn.commit()
+@functools.lru_cache(maxsize=1)
+def _file_url_tmpl() -> str:
+    # construit une fois par worker (dépend du client blob, lui-même créé à la 1re utilisation)
+    return f"{_blob_service().url}/{SOURCE_CONTAINER}/{{}}"
 
-    logging.info(f"🗃️ SQL OK — Invoice.Number={num}  Amount={amount}")
+def _sql_date(s: object) -> object:
+    # texte ISO 8601 (indépendant de SET DATEFORMAT), converti par CAST dans l'insert de @rows.
+    # fastmssql déclare un None en tinyint, sans conversion possible vers DATETIME2 (erreur 206):
+    # une date absente ou illisible part en NULL typé
+    d = to_date(s)
+    return TypedNull.DATETIME2 if d is None else d.isoformat()
 
-# ----- BLOB TRIGGER : écoute 'eem-training/{name}'
-@app.function_name(name="ProcessInvoice")
-@app.blob_trigger(arg_name="myblob", path="eem-training/{name}", connection="AzureWebJobsStorage")
-def ProcessInvoice(myblob: func.InputStream):
+def _insert_statement(common: list, rows: list) -> tuple:
+    params = list(common)
+    values = []
+    for row in rows:
+        base = len(params)
+        values.append("(" + ",".join(col.format(f"@P{base + j}") for j, col in enumerate(_ROW_COLUMNS, 1)) + ")")
+        params += row
+    return _INSERT_INVOICES_SQL.format(values=",".join(values)), params
+
+async def save_to_db(invoices: list):
+    """invoices: [(fields, blob_name, original, stem), ...] — tout le lot en un aller-retour SQL."""
+    rows = []
+
+    # Un même blob peut apparaître deux fois dans un lot (retry Event Grid): on ne le garde qu'une fois
+    for fields, blob_name, original, _ in {inv[1]: inv for inv in invoices}.values():
+        # Champs issus du modèle; une valeur inexploitable (montant avec devise...) n'écarte que sa facture
+        try:
+            num   = (fields.get("NumeroFacture") or {}).get("value")
+            issue = (fields.get("DateEmission")  or {}).get("value")
+            due   = (fields.get("DateEcheance")  or {}).get("value")
+            amt   = (fields.get("MontantTotal")  or {}).get("value")
+            if not any((num, issue, due, amt)):
+                logging.warning(f"Aucun champ facture extrait, pas d'écriture SQL pour {blob_name}")
+                continue
+            rows.append([blob_name, original, _file_url_tmpl().format(original),
+                         num or "", _sql_date(issue), _sql_date(due), to_amount(amt)])
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.error(f"Champs facture inexploitables, pas d'écriture SQL pour {blob_name}: {e!r}")
+
+    if not rows:
+        return
+    try:
+        await _insert_rows(rows)
+    except SqlError as e:
+        if not _is_permanent(e):
+            raise
+        # Une seule ligne refusée (contrainte, troncature...) fait échouer tout l'insert groupé:
+        # reprise facture par facture pour n'écarter que la fautive
+        logging.warning(f"Insert groupé refusé (SQL {e.code}), reprise facture par facture: {e.message}")
+        inserted = 0
+        for row in rows:
+            try:
+                await _insert_rows([row])
+                inserted += 1
+            except SqlError as err:
+                if not _is_permanent(err):
+                    raise
+                logging.error(f"Facture refusée par SQL, ignorée ({row[0]}): {err.code} {err.message}")
+        logging.info(f"🗃️ SQL OK — {inserted}/{len(rows)} facture(s) enregistrée(s)")
+        return
+
+    logging.info(f"🗃️ SQL OK — {len(rows)} facture(s) enregistrée(s)")
+
+async def _insert_rows(rows: list):
+    common = [SOURCE_CONTAINER, DEFAULT_SITE_ID, DEFAULT_STATUS_ID, CREATED_BY, "blobTrigger"]
+    statements = [_insert_statement(common, rows[i:i + _SQL_MAX_ROWS])
+                  for i in range(0, len(rows), _SQL_MAX_ROWS)]
+    if len(statements) == 1:
+        await SQL.execute(*statements[0])
+    else:
+        # connexion dédiée: les COMMIT internes restent imbriqués, tout le lot passe ou rien
+        async with Transaction(SQL_CONN_STR) as tx:
+            await tx.execute_batch(statements)
+
+# ---------- Erreurs: ce qui doit être rejoué par l'hôte ----------
+# Une exception qui remonte de ProcessInvoice fait abandonner le lot: Service Bus le redélivre
+# (puis le passe en dead-letter après maxDeliveryCount). Grâce au cache DI et à l'insert idempotent,
+# un rejeu ne refait ni les analyses terminées ni les écritures déjà faites. Par défaut tout est donc
+# rejoué: panne passagère, mais aussi configuration cassée (clé, SAS, token...) qui doit finir en
+# dead-letter plutôt que perdre la facture. Seules les erreurs de donnée connues sont définitives
+# (journalisées, seul l'évènement ou la facture est écarté):
+#   - document refusé par DI pour son contenu (DocumentRejected);
+#   - HTTP 4xx: requête refusée telle quelle, sauf 408/429 (passagers) et 401/403/404 (accès, clé,
+#     modèle ou conteneur introuvable: configuration, donc rejoués jusqu'au dead-letter);
+#   - SQL: contrainte, conversion ou troncature sur la ligne elle-même.
+# Les champs inexploitables (montant avec devise...) sont déjà écartés par save_to_db.
+_HTTP_REPLAYED_4XX = frozenset((401, 403, 404, 408, 429))
+_SQL_DATA_ERRORS   = frozenset((206, 220, 232, 241, 242, 245, 515, 547, 2601, 2627, 2628,
+                                8114, 8115, 8152))
+
+def _is_permanent(exc: BaseException) -> bool:
+    if isinstance(exc, DocumentRejected):
+        return True
+    if isinstance(exc, SqlError):
+        return exc.code in _SQL_DATA_ERRORS
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+    elif isinstance(exc, HttpResponseError):
+        code = exc.status_code or 0   # 0: échec d'analyse DI hors contenu (source inaccessible...)
+    else:
+        return False
+    return 400 <= code < 500 and code not in _HTTP_REPLAYED_4XX
+
+async def process_event(msg: func.ServiceBusMessage):
+    """Évènement BlobCreated -> (champs extraits, nom du blob, nom de fichier, radical), None si rien à enregistrer."""
+    # 1) Évènement: un message illisible ne passera jamais, inutile de le rejouer
+    try:
+        event = orjson.loads(msg.get_body())
+        if event.get("eventType") != "Microsoft.Storage.BlobCreated":
+            logging.info(f"Évènement ignoré: {event.get('eventType')}")
+            return None
+        url = event["data"]["url"]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.error(f"Message invalide ignoré ({msg.message_id}): {e!r}")
+        return None
+
+    # https://<compte>.blob.core.windows.net/<container>/<blob> ; client du pool partagé
+    container, _, name = unquote(urlparse(url).path).lstrip("/").partition("/")
+    # Garde-fou si le filtre d'abonnement manque: nos propres écritures dans 'archive'
+    # (raw/, *.json, cache/) reviendraient sinon comme évènements (doublons SQL, appels DI)
+    if container != SOURCE_CONTAINER:
+        logging.info(f"Évènement ignoré (container '{container}'): {name}")
+        return None
+    blob = _blob_service().get_blob_client(container, name)
+    blob_name = f"{container}/{name}"
+    original = os.path.basename(name)
+    stem = original.rsplit(".", 1)[0]
+
+    # 2) Lecture blob + cache: erreurs -> remontées (classées par _is_permanent), blob supprimé -> ignoré
     try:
-        logging.info(f"🔔 Nouveau blob: {myblob.name} ({myblob.length} bytes)")
+        digest, size, etag = await _content_digest(blob)
+        logging.info(f"🔔 Nouveau blob: {blob_name} ({size} bytes)")
+        cache_name = _cache_blob_name(digest)
+        data = await load_cached_fields(cache_name)
+    except ResourceNotFoundError:
+        logging.warning(f"⚠️ Blob introuvable (supprimé ?): {blob_name}")
+        return None
 
-        req = AnalyzeDocumentRequest(bytes_source=myblob.read())
-        poller = di_client.begin_analyze_document(model_id=MODEL_ID, body=req)
-        result = poller.result()
+    if data is not None:
+        logging.info(f"♻️ Résultat DI en cache: {ARCHIVE_CONTAINER}/{cache_name}")
+    else:
+        # 3) Analyse DI (retryable): un document refusé pour son contenu est ignoré, le reste remonte.
+        # DI async: pendant son polling, la boucle archive la copie brute et traite les autres blobs du lot
+        try:
+            fields, _ = await asyncio.gather(analyze_blob(blob), archive_raw_copy(original, _read_sas_url(blob)))
+        except DocumentRejected as e:
+            logging.error(f"Analyse DI refusée pour {blob_name}: {e}")
+            return None
 
-        if not result.documents:
-            logging.warning("⚠️ Aucun document détecté")
-            return
+        # DI relit le blob via le SAS: s'il a été remplacé depuis le hachage, le résultat ne correspond
+        # plus à cache_name. Le nouveau contenu a son propre évènement BlobCreated: celui-ci est écarté.
+        try:
+            current = (await blob.get_blob_properties()).etag
+        except ResourceNotFoundError:
+            current = None
+        if current != etag:
+            logging.warning(f"⚠️ Blob modifié ou supprimé pendant l'analyse, évènement ignoré: {blob_name}")
+            return None
 
-        doc = result.documents[0]
+        # Aucun document -> {} mis en cache aussi: un ré-upload du même fichier vide ne repasse pas par DI
         data = { name: {"value": extract_value(field), "confidence": field.confidence}
-                 for name, field in (doc.fields or {}).items() }
+                 for name, field in (fields or {}).items() }
+        try:
+            await save_cached_fields(cache_name, data)
+        except HttpResponseError as e:
+            # le cache n'est qu'une optimisation: on continue sans lui
+            logging.warning(f"Cache DI non écrit ({cache_name}): {e}")
 
-        logging.info("✅ Champs extraits: " + json.dumps(data, ensure_ascii=False))
+    if not data:
+        logging.warning(f"⚠️ Aucun document détecté: {blob_name}")
+        return None
+
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("✅ Champs extraits: %s", list(data))
+    return data, blob_name, original, stem
 
-        # 1) Archive JSON d’audit
-        save_json_to_archive(myblob.name, data)
+# ----- SERVICE BUS TRIGGER (lots) : évènements Event Grid Microsoft.Storage.BlobCreated
+# Abonnement Event Grid (system topic du compte de stockage) filtré sur
+#   subjectBeginsWith = /blobServices/default/containers/eem-training/
+# avec pour destination la file Service Bus 'invoice-events' (schéma Event Grid).
+# Le trigger Event Grid Python ne reçoit qu'un évènement par invocation; la file permet de
+# recevoir jusqu'à extensions.serviceBus.maxMessageBatchSize messages (host.json) d'un coup.
+@app.function_name(name="ProcessInvoice")
+@app.service_bus_queue_trigger(arg_name="messages", queue_name="invoice-events",
+                               connection="ServiceBusConnection", cardinality=func.Cardinality.MANY)
+async def ProcessInvoice(messages: List[func.ServiceBusMessage]):
+    # Tous les évènements vont au bout (résultats DI mis en cache) et les factures prêtes sont écrites
+    # avant un éventuel rejeu du lot: l'insert idempotent ne les dupliquera pas au rejeu. Ainsi un
+    # document en échec répété ne fait pas passer en dead-letter les factures saines de son lot.
+    results = await asyncio.gather(*(process_event(m) for m in messages), return_exceptions=True)
+    errors = []
+    for m, r in zip(messages, results, strict=True):
+        if not isinstance(r, BaseException):
+            continue
+        if _is_permanent(r):
+            logging.error(f"Erreur définitive, évènement ignoré ({m.message_id}): {r!r}")
+        else:
+            logging.error(f"Erreur, lot rejoué ({m.message_id}): {r!r}")
+            errors.append(r)
 
-        # 2) Insert en base (sql)
-        account_url = blob_service.url
-        save_to_db(data, myblob.name, account_url, container="eem-training")
+    invoices = [r for r in results if r is not None and not isinstance(r, BaseException)]
+    if invoices:
+        # Archives JSON d’audit et insert en base (sql) du lot: indépendants -> en parallèle.
+        # SQL est transactionnel: en cas d'échec rien n'est écrit et, sauf erreur de donnée, le lot est
+        # rejoué (DI en cache, archives réécrites à l'identique). Une archive manquée après un insert
+        # réussi est seulement journalisée: le JSON reste disponible dans le cache DI.
+        sql_result, *archived = await asyncio.gather(
+            save_to_db(invoices),
+            *(save_json_to_archive(stem, data) for data, _, _, stem in invoices),
+            return_exceptions=True,
+        )
+        for (_, blob_name, _, _), r in zip(invoices, archived, strict=True):
+            if isinstance(r, BaseException):
+                logging.error(f"Archive JSON non écrite pour {blob_name}: {r!r}")
+        if isinstance(sql_result, BaseException):
+            if _is_permanent(sql_result):
+                logging.error(f"Écriture SQL du lot abandonnée (erreur définitive): {sql_result!r}")
+            else:
+                errors.insert(0, sql_result)
 
-    except Exception as e:
-        logging.exception(f"Erreur traitement blob: {e}")
+    if errors:
+        raise errors[0]
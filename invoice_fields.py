@@ -0,0 +1,73 @@
+# Helpers "chauds" de ProcessInvoice (appelés pour chaque champ / chaque facture).
+# Module pur Python entièrement annoté: compilé AOT par mypyc (python setup.py build_ext --inplace),
+# le worker Functions charge alors le .so à la place du .py.
+from __future__ import annotations
+
+import datetime as dt
+from typing import Callable
+
+from azure.ai.documentintelligence.models import DocumentField
+
+# ---------- Extraction des valeurs DI ----------
+def _currency(field: DocumentField) -> dict[str, object] | None:
+    cur = field.value_currency
+    if cur:
+        return {"amount": getattr(cur,"amount",None),
+                "currency": getattr(cur,"currency_code",None) or getattr(cur,"currency_symbol",None)}
+    return None
+
+def _value_string(field: DocumentField) -> object: return field.value_string
+def _value_number(field: DocumentField) -> object: return field.value_number
+def _value_date(field: DocumentField) -> object: return field.value_date   # date/time sérialisés nativement par orjson
+def _value_time(field: DocumentField) -> object: return field.value_time
+def _value_integer(field: DocumentField) -> object: return field.value_integer
+
+# ftype -> extracteur: une recherche dans un dict au lieu d'une cascade de if par champ
+_EXTRACTORS: dict[str, Callable[[DocumentField], object]] = {
+    "string": _value_string, "countryRegion": _value_string, "phoneNumber": _value_string,
+    "date": _value_date,
+    "time": _value_time,
+    "integer": _value_integer,
+    "number": _value_number, "float": _value_number,
+    "currency": _currency,
+}
+_OBJECT_TYPES = frozenset(("object", "dictionary", "map"))
+
+def extract_value(field: DocumentField) -> object:
+    ftype: str = getattr(field, "type", None) or getattr(field, "value_type", None) or ""
+    fn = _EXTRACTORS.get(ftype)
+    if fn: return fn(field)
+    # types récursifs
+    if ftype == "array": return [extract_value(x) for x in (field.value_array or [])]
+    if ftype in _OBJECT_TYPES:
+        obj = field.value_object or {}
+        return {k: extract_value(v) for k,v in obj.items()}
+    return field.content
+
+# ---------- Normalisation date / montant ----------
+# "1 234.567,89" -> "1234567.89" en une seule passe C (espaces, insécables et séparateurs de milliers retirés)
+_AMT_TRANS = str.maketrans({" ": None, "\u00a0": None, ".": None, ",": "."})
+
+_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%d/%m/%Y")
+
+def to_date(s: object) -> dt.datetime | None:
+    # Dispatch sur la forme de la chaîne; la cascade strptime ne sert plus que de repli
+    if not s: return None
+    if isinstance(s, dt.datetime): return s
+    if isinstance(s, dt.date): return dt.datetime(s.year, s.month, s.day)   # valeur DI (hors cache)
+    text = str(s)
+    try:
+        if len(text) == 10 and text[4] == "-": return dt.datetime.fromisoformat(text)                          # %Y-%m-%d
+        if len(text) == 10 and text[2] == "/": return dt.datetime(int(text[6:]), int(text[3:5]), int(text[:2]))  # %d/%m/%Y
+        if len(text) >= 19 and text[10] == "T": return dt.datetime.fromisoformat(text[:19])                   # %Y-%m-%dT%H:%M:%S
+    except ValueError:
+        pass
+    # Formes non canoniques ("2024-1-5", "5/1/2024"...): repli sur les anciens formats strptime
+    for fmt in _DATE_FORMATS:
+        try: return dt.datetime.strptime(text, fmt)
+        except ValueError: continue
+    return None
+
+def to_amount(s: object) -> float:
+    if s is None: return 0.0
+    return float(str(s).translate(_AMT_TRANS))
@@ -0,0 +1,9 @@
+# Compilation AOT (mypyc) des helpers chauds: python setup.py build_ext --inplace
+# -> invoice_fields.*.so à côté de function_app.py, importé en priorité sur invoice_fields.py.
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="func-invoices2",
+    ext_modules=mypycify(["--ignore-missing-imports", "invoice_fields.py"]),
+)